@@ -14,6 +14,7 @@
 # Additionally, these files may be created and captured in the process:
 #  - tmp/fev.sby & tmp/fev.eqy: The FEV script for this conversion job.
 #  - tmp/llm.v, tmp/tmp.v, tmp/working.v: Temporary versions of the Verilog used after LLM runs before LLM and/or human changes are accepted/rejected.
+#  - tmp/llm_cache/<hash>.txt: Cached LLM responses, keyed by a hash of the prompt ID, model, messages, and Verilog of the request.
 #  - <module_name>_prep.v: The file sent to the LLM API.
 #  - <module_name>_llm.v: The LLM output file.
 #  - llm_response.txt: The LLM response file.
@@ -92,11 +93,12 @@ import termios
 import tty
 import atexit
 import signal
-from select import select
 from abc import ABC, abstractmethod
 import json
 import re
 import shutil
+import hashlib
+import stat
 
 # Confirm that we're using Python 3.7 or later (as we rely on dictionaries to be ordered).
 if sys.version_info < (3, 7):
@@ -110,6 +112,7 @@ if sys.version_info < (3, 7):
 class LLM_API(ABC):
   name = "LLM"
   model = None
+  finish_reason = None   # The finish reason reported for the last run(..) ("stop" for a complete response).
 
   def __init__(self):
     pass
@@ -156,7 +159,8 @@ class MessageBundler:
   def content_to_obj(self, content):
     pass
 
-  # Add Verilog to last message to be sent to the API.
+  # Return the messages to be sent to the API, with Verilog added to the last message.
+  # The given messages are not modified.
   # messages: The messages.json object in OpenAI format.
   # verilog: The current Verilog file contents.
   @abstractmethod
@@ -173,28 +177,36 @@ class OpenAI_API(LLM_API):
     # if OPENAI_API_KEY env var does not exist, get it from ~/.openai/key.txt or input prompt.
     if not os.getenv("OPENAI_API_KEY"):
       key_file_name = os.path.expanduser("~/.openai/key.txt")
-      if os.path.exists(key_file_name):
+      try:
         with open(key_file_name) as file:
-          os.environ["OPENAI_API_KEY"] = file.read()
-      else:
+          # (Strip the trailing newline, which would otherwise be sent in the Authorization header.)
+          os.environ["OPENAI_API_KEY"] = file.read().strip()
+      except FileNotFoundError:
         os.environ["OPENAI_API_KEY"] = input("Enter your OpenAI API key: ")
     
     # Use an organization in the request if one is provided, either in the OPENAI_ORG_ID env var or in ~/.openai/org_id.txt.
     self.org_id = os.getenv("OPENAI_ORG_ID")
     if not self.org_id:
       org_file_name = os.path.expanduser("~/.openai/org_id.txt")
-      if os.path.exists(org_file_name):
+      try:
         with open(org_file_name) as file:
-          self.org_id = file.read()
+          self.org_id = file.read().strip()
+      except FileNotFoundError:
+        pass
     
     # Init OpenAI.
     self.client = OpenAI() if self.org_id is None else OpenAI(organization=self.org_id)
-    self.models = self.client.models.list()
+    self.model_ids = None   # Listed on first use (to avoid a round trip at startup).
   
+  # Return the set of available model IDs, listing them on first use.
+  def getModelIds(self):
+    if self.model_ids is None:
+      models = self.client.models.list()
+      self.model_ids = {item.id for item in models.data if hasattr(item, 'id')}
+    return self.model_ids
+
   def validateModel(self, model):
-    # Get the data for the model (or None if not found)
-    model_data = next((item for item in self.models.data if hasattr(item, 'id') and item.id == model), None)
-    if model_data is None:
+    if model not in self.getModelIds():
       print("Error: Model " + model + " not found.")
       fail()
 
@@ -214,19 +226,37 @@ class OpenAI_API(LLM_API):
     self.validateModel(model)
     
     # Add verilog to the last message.
-    message_bundler.add_verilog(messages, verilog)
+    messages = message_bundler.add_verilog(messages, verilog)
 
     # Call the API.
     print("\nCalling " + model + "...")
     # TODO: Not supported in ChatGPT-3.5: response_format = {"type": "json_object"}
-    api_response = self.client.chat.completions.create(model=model, messages=messages, max_tokens=3000, temperature=0.0)
-    print("Response received from " + model)
+    # The response is streamed, so progress can be reported as it is generated.
+    api_response = self.client.chat.completions.create(model=model, messages=messages, max_tokens=3000, temperature=0.0,
+                                                       stream=True, stream_options={"include_usage": True})
 
-    # Parse the response.
+    # Accumulate the response.
     try:
-      response_str = api_response.choices[0].message.content
-      finish_reason = api_response.choices[0].finish_reason
-      completion_tokens = api_response.usage.completion_tokens
+      parts = []
+      response_len = 0
+      finish_reason = None
+      completion_tokens = None
+      for chunk in api_response:
+        # The final chunk has no choices, only usage.
+        if chunk.choices:
+          content = chunk.choices[0].delta.content
+          if content:
+            parts.append(content)
+            response_len += len(content)
+            print("\rReceived " + str(response_len) + " characters", end="", flush=True)
+          if chunk.choices[0].finish_reason:
+            finish_reason = chunk.choices[0].finish_reason
+        if chunk.usage:
+          completion_tokens = chunk.usage.completion_tokens
+      response_str = "".join(parts)
+      self.finish_reason = finish_reason
+      print("")
+      print("Response received from " + model)
       print("API response finish reason: " + finish_reason)
       print("API response completion tokens: " + str(completion_tokens))
     except Exception as e:
@@ -236,9 +266,18 @@ class OpenAI_API(LLM_API):
     return response_str
 
 # Response fields.
-response_fields = {"overview", "verilog", "notes", "issues", "modified", "incomplete", "plan"}    # ("incomplete" is sticky between LLM runs, so it has special treatment.)
-status_fields = {"by", "compile", "fev", "incomplete", "modified", "accepted", "plan"}
-llm_status_fields = {"incomplete", "plan"}   # These are empty for a refactoring step and updated by LLM runs.
+response_fields = frozenset({"overview", "verilog", "notes", "issues", "modified", "incomplete", "plan"})    # ("incomplete" is sticky between LLM runs, so it has special treatment.)
+status_fields = frozenset({"by", "compile", "fev", "incomplete", "modified", "accepted", "plan"})
+llm_status_fields = frozenset({"incomplete", "plan"})   # These are empty for a refactoring step and updated by LLM runs.
+
+# Regular expressions used to parse LLM responses (compiled once).
+section_re = re.compile(r"\/\/ LLM:\s*(Omitted)?\s*Section:\s*([^\n]+)\n")   # Verilog section header comment
+leading_blank_lines_re = re.compile(r"\A(?:[^\S\n]*\n)+")
+trailing_space_re = re.compile(r"\s*$")
+verilog_block_quote_re = re.compile(r"^```(verilog)?\n(.*)\n+```\n?$", re.DOTALL)
+field_header_re = re.compile(r"^## +(\w+)[^\n]*\n?", re.MULTILINE)   # (The field name is captured.)
+field_name_re = re.compile(r"[a-z_]*")
+
 class PseudoMarkdownMessageBundler(MessageBundler):
   # Convert the given object to a pseudo-Markdown format. Markdown syntax is familiar to the LLM, and fields can be
   # provided without any awkward escaping and other formatting, as described in default_system_message.txt.
@@ -254,14 +293,12 @@ class PseudoMarkdownMessageBundler(MessageBundler):
   #   module...
   #   endmodule
   def obj_to_request(self, obj):
-    content = ""
-    separator = ""
+    sections = []
     for key in obj:
       # Convert (single-word) key to title case.
       name = key[0].upper() + key[1:]
-      content += separator + "## " + name + "\n\n" + obj[key]
-      separator = "\n\n"
-    return content
+      sections.append("## " + name + "\n\n" + obj[key])
+    return "\n\n".join(sections)
 
   # Split a Verilog file into sections delimited by "// LLM: [Omitted ]Section: <name>"
   # (as described in default_system_message.txt).
@@ -269,7 +306,7 @@ class PseudoMarkdownMessageBundler(MessageBundler):
   # response: A boolean indicating whether the body is a response (vs. request).
   def split_sections(self, body, response):
     # Match sections, delimited by "// LLM: Section: <name>".
-    sections = re.split(r"\/\/ LLM:\s*(Omitted)?\s*Section:\s*([^\n]+)\n", body)
+    sections = section_re.split(body)
     # Give the first section a name if it is missing.
     if (sections[0] == ""):
       # Delete the first empty string.
@@ -307,92 +344,82 @@ class PseudoMarkdownMessageBundler(MessageBundler):
   # response: The response string from the LLM API.
   # verilog: The original Verilog code, needed to reconstruct sections that are omitted in the response.
   def response_to_obj(self, response, verilog):
-    # Parse the response, line by line, looking for second-level Markdown header lines.
-    lines = response.split("\n")
-    l = 0
+    # Split the response on second-level Markdown header lines into [preamble, field, body, field, body, ...].
+    parts = field_header_re.split(response)
     fields = {}
-    field = None
-    while l < len(lines):
-      # Parse body lines until the next field header or end of message.
-      body = ""
-      separator = ""
-      while l < len(lines) and not lines[l].startswith("## "):
-        if (body != "") or (re.match(r"^\s*$", lines[l]) is None):    # Ignore leading blank lines.
-          body += separator + lines[l]
-          separator = "\n"
-        l += 1
-      # Found header line or EOM.
-
-      # Process the body field that ended.
-      
-      # Strip trailing whitespace.
-      body = re.sub(r"\s*$", "", body)
-      if field is None:
-        if body != "":
-          print("Error: The following body text was found before the first header and will be ignored:")
-          print(body)
-      else:
-        # "verilog" field should not be in block quotes, but it's hard to convince the LLM, so strip them if present.
-        if field == "verilog":
-          body, n = re.subn(r"^```(verilog)?\n(.*)\n+```\n?$", r"\2\n", body, flags=re.DOTALL)
-          if n != 0:
-            print("Warning: The \"verilog\" field of the response was contained in block quotes. They were stripped.")
-          
-          # Make sure the Verilog code ends with a newline (because we pattern match lines ending in newline).
-          if body != "" and body[-1] != "\n":
-            body += "\n"
-          
-          # Split the request and response Verilog into sections.
-          [response_sections, response_omitted] = self.split_sections(body, True)
-          [orig_sections, orig_omitted] = self.split_sections(verilog, False)
-
-          # Reconstruct the full response Verilog, adding omitted sections from the original Verilog.
-          body = ""
-          for name, code in response_sections.items():
-            if name:
-              body += "// LLM: Section: " + name + "\n"
-            omitted = response_omitted[name]
-            # Add the section from the original Verilog if it was omitted.
-            if omitted:
-              body += orig_sections[name]
-            else:
-              body += code
-
-        # Capture the previous field.
-        # Boolean responses.
-        if body == "true" or body == "false":
-          body = body == "true"
-        # Capture the field body.
-        fields[field] = body
-        
-      if l < len(lines):
-        # Parse the header line with a regular expression.
-        field = re.match(r"## +(\w+)", lines[l]).group(1)
 
-        # The field name should be a lower-case words with underscore delimitation.
-        if not re.match(r"[a-z_]*", field):
-          print("Warning: The following malformed field name was found in the response:")
-          print(field)
+    # Text before the first header is ignored.
+    preamble = self.trim_body(parts[0])
+    if preamble != "":
+      print("Error: The following body text was found before the first header and will be ignored:")
+      print(preamble)
 
-        # Convert field name to lower case.
-        field = field.lower()
-          
-        # Check for legal field name.
-        if field not in response_fields | set(prompts[prompt_id].get("must_produce", [])) | set(prompts[prompt_id].get("may_produce", [])):
-          print("Warning: The following non-standard field was found in the response:")
-          print(field)
+    for i in range(1, len(parts), 2):
+      field = parts[i]
 
-        # Done with this header line.
-        l += 1
+      # The field name should be a lower-case words with underscore delimitation.
+      if not field_name_re.match(field):
+        print("Warning: The following malformed field name was found in the response:")
+        print(field)
+
+      # Convert field name to lower case.
+      field = field.lower()
+        
+      # Check for legal field name.
+      if field not in response_fields | set(prompts[prompt_id].get("must_produce", [])) | set(prompts[prompt_id].get("may_produce", [])):
+        print("Warning: The following non-standard field was found in the response:")
+        print(field)
+
+      body = self.trim_body(parts[i + 1])
+
+      # "verilog" field should not be in block quotes, but it's hard to convince the LLM, so strip them if present.
+      if field == "verilog":
+        body, n = verilog_block_quote_re.subn(r"\2\n", body)
+        if n != 0:
+          print("Warning: The \"verilog\" field of the response was contained in block quotes. They were stripped.")
+        
+        # Make sure the Verilog code ends with a newline (because we pattern match lines ending in newline).
+        if body != "" and body[-1] != "\n":
+          body += "\n"
+        
+        # Split the request and response Verilog into sections.
+        [response_sections, response_omitted] = self.split_sections(body, True)
+        [orig_sections, orig_omitted] = self.split_sections(verilog, False)
+
+        # Reconstruct the full response Verilog, adding omitted sections from the original Verilog.
+        body_parts = []
+        for name, code in response_sections.items():
+          if name:
+            body_parts.append("// LLM: Section: " + name + "\n")
+          omitted = response_omitted[name]
+          # Add the section from the original Verilog if it was omitted.
+          if omitted:
+            body_parts.append(orig_sections[name])
+          else:
+            body_parts.append(code)
+        body = "".join(body_parts)
+
+      # Boolean responses.
+      if body == "true" or body == "false":
+        body = body == "true"
+      # Capture the field body.
+      fields[field] = body
     
     return fields
 
-  # Add Verilog to last message to be sent to the API.
+  # Strip leading blank lines and trailing whitespace from the body of a response field.
+  def trim_body(self, body):
+    return trailing_space_re.sub("", leading_blank_lines_re.sub("", body))
+
+  # Return the messages to be sent to the API, with Verilog added to the last message.
+  # The given messages are not modified.
   # messages: The messages.json object in OpenAI format.
   # verilog: The current Verilog file contents.
   def add_verilog(self, messages, verilog):
-    # Add verilog to the last message.
-    messages[-1]["content"] += "\n\n## verilog\n\n" + verilog
+    # Replace the last message with a copy that includes the verilog. (Other messages are shared.)
+    last_message = dict(messages[-1])
+    last_message["content"] += "\n\n## verilog\n\n" + verilog
+    return messages[:-1] + [last_message]
 
 
 def changes_pending():
@@ -412,6 +439,44 @@ def copy_if_different(src, dest):
   if diff(src, dest):
     shutil.copyfile(src, dest)
 
+# LLM responses are cached on disk so that identical requests (e.g. after a reversion) are not resent.
+# Only complete responses (finish reason "stop") are cached, and responses that are rejected (automatically or by the user) are evicted.
+# Set CONVERT_LLM_CACHE=0 to disable the cache, or CONVERT_LLM_CACHE_REFRESH=1 to ignore cached responses (while still caching new ones).
+llm_cache_dir = "tmp/llm_cache"
+llm_cache_enabled = os.getenv("CONVERT_LLM_CACHE", "1") == "1"
+llm_cache_refresh = os.getenv("CONVERT_LLM_CACHE_REFRESH", "0") == "1"
+
+# The cache key for an LLM request.
+# The prompt ID is included, since the response is interpreted according to the prompt (e.g. its "must_produce" fields).
+def llm_cache_key(messages, verilog, model):
+  request = json.dumps({"prompt_id": prompt_id, "model": model, "messages": messages, "verilog": verilog}, sort_keys=True)
+  return hashlib.sha256(request.encode()).hexdigest()
+
+# Return the cached response string for the given key, or None.
+def read_llm_cache(key):
+  if not llm_cache_enabled or llm_cache_refresh:
+    return None
+  try:
+    with open(llm_cache_dir + "/" + key + ".txt") as file:
+      return file.read()
+  except FileNotFoundError:
+    return None
+
+# Cache the given response string under the given key.
+def write_llm_cache(key, response_str):
+  if not llm_cache_enabled:
+    return
+  os.makedirs(llm_cache_dir, exist_ok=True)
+  # (Written atomically, so an interrupted write cannot leave a truncated response in the cache.)
+  write_file_atomically(llm_cache_dir + "/" + key + ".txt", response_str)
+
+# Remove the cached response for the given key (if any), so it will not be replayed.
+def evict_llm_cache(key):
+  try:
+    os.remove(llm_cache_dir + "/" + key + ".txt")
+  except FileNotFoundError:
+    pass
+
 # Checkpoint any manual edits, run LLM, and checkpoint the result if successful. Return nothing.
 # messages: The messages.json object in OpenAI format.
 # verilog: The current Verilog file contents.
@@ -428,18 +493,32 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
   print("")
   press_any_key()
 
+  cache_key = llm_cache_key(messages, verilog, model)
+
   # If there is already a response, prompt the user about possibly reusing it.
-  # TODO: Consider using a disk/DB memoization library to cache responses, such as https://grantjenks.com/docs/diskcache/.
   ch = "n"
+  declined = False   # The user declined to reuse the existing response.
   if os.path.exists("llm_response.txt"):
     ch = prompt("There is already a response to this prompt. Would you like to reuse it [y/N]?")
+    declined = ch != "y"
   if ch == "y":
     # Use llm_response.txt.
     with open("llm_response.txt") as file:
       response_str = file.read()
   else:
-    # Call the API.
-    response_str = llm_api.run(messages, verilog, model)
+    # Use a cached response for an identical request (unless the user just declined one, and if the user confirms), or call the API.
+    response_str = None if declined else read_llm_cache(cache_key)
+    if response_str is not None:
+      ch = prompt("There is a cached response to an identical prior request. Would you like to reuse it [y/N]?")
+      if ch != "y":
+        # Replace the cached response with a new one.
+        evict_llm_cache(cache_key)
+        response_str = None
+    if response_str is None:
+      response_str = llm_api.run(messages, verilog, model)
+      # Cache only complete responses (not, e.g., those truncated by the token limit).
+      if llm_api.finish_reason == "stop":
+        write_llm_cache(cache_key, response_str)
     # Write llm_response.txt.
     with open("llm_response.txt", "w") as file:
       file.write(response_str)
@@ -477,22 +556,18 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
       print("Rejecting response.")
       must_reject = True
 
-  if not must_reject:
+  if must_reject:
+    # Don't replay the rejected response for this request.
+    evict_llm_cache(cache_key)
+  else:
     # Confirm.
     print("")
     print("The following response was received from the API, to replace the Verilog file:")
     print("")
     # Reformat the JSON into multiple lines and extract the verilog for cleaner printing.
+    # (A shallow copy is printed, so the response itself is untouched.)
     code = response_obj.get("verilog")
-    if code:
-      response_obj["verilog"] = "See meld."
-    print(json.dumps(response_obj, indent=4))
-    if code:
-      #print("-------------")
-      #print(code)
-      #print("-------------")
-      # Repair the response.
-      response_obj["verilog"] = code
+    print(json.dumps(dict(response_obj, verilog="See meld.") if code else response_obj, indent=4))
     print("")
 
     # Get working code.
@@ -512,7 +587,7 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
         modified = True
     
     # Save off working file.
-    os.system("mv " + working_verilog_file_name + " tmp/working.v")
+    os.replace(working_verilog_file_name, "tmp/working.v")
     # Write tmp/llm.v and working Verilog file with LLM's Verilog output.
     code = response_obj["verilog"] if modified else working_code
     with open("tmp/llm.v", "w") as file:
@@ -549,7 +624,7 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
       
       # Checkpoint, whether modified or not.
       # Capture the current Verilog file temporarily in tmp/tmp.v.
-      os.system("cp " + working_verilog_file_name + " tmp/tmp.v")
+      shutil.copyfile(working_verilog_file_name, "tmp/tmp.v")
       # Copy the LLM's Verilog file to the working Verilog file.
       copy_if_different("tmp/llm.v", working_verilog_file_name)
       # Checkpoint the LLM's change.
@@ -578,46 +653,22 @@ def run_llm(messages, verilog, model="gpt-3.5-turbo"):
       # Revert to the prior change.
       copy_if_different("tmp/working.v", working_verilog_file_name)
       print("Changes rejected. Restored to prior version.")
+      # Don't replay the rejected response for this request.
+      evict_llm_cache(cache_key)
+
+# A quoted JSON string (including escaped characters).
+json_string_re = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
 
 # Process JSON with newlines in strings into proper JSON.
 def from_extended_json(ejson):
-  # Iterate over the characters of raw_contents, keeping track of whether we are within a string, and replacing newlines with '\n'.
+  # Replace newlines within strings with '\n'.
   # For backward-compatibility with an old syntax, we replace "\n+" as well as "\n" with '\n'.
-  json_str = ""
-  in_string = False
-  after_newline = False
-  for c in ejson:
-    if after_newline:
-      if c == '+':
-        after_newline = False
-        continue
-      after_newline = False
-    if c == '"':
-      in_string = not in_string
-    if c == '\n' and in_string:
-      c = '\\n'
-      after_newline = True
-    json_str += c
-  return json_str
+  return json_string_re.sub(lambda m: m.group(0).replace("\n+", "\\n").replace("\n", "\\n"), ejson)
 
 # Convert a JSON string into a more readable version with newlines in strings.
 def to_extended_json(json_str):
-  # Iterate over the characters of the JSON string, keeping track of whether we are within a string, and replacing '\n' with newlines.
-  ejson = ""
-  in_string = False
-  prev_c = None
-  for c in json_str:
-    if c == '"':
-      in_string = not in_string
-    if prev_c == '\\' and c == 'n' and in_string:
-      prev_c = None
-      c = '\n'
-    if prev_c != None:
-      ejson += prev_c
-    prev_c = c
-  if prev_c != None:
-    ejson += prev_c
-  return ejson
+  # Replace '\n' within strings with newlines.
+  return json_string_re.sub(lambda m: m.group(0).replace("\\n", "\n"), json_str)
 
 
 #############
@@ -683,10 +734,33 @@ def llm_finished():
   return not readStatus().get("incomplete", True)
 
 def fev_passed():
-  return os.path.exists("fev/PASS") and os.system("diff " + module_name + ".v fev/src/" + module_name + ".v") == 0
+  return os.path.exists("fev/PASS") and not diff(module_name + ".v", "fev/src/" + module_name + ".v")
 
+# Return True if the given files differ (or either cannot be read).
+# The files are small, so they are compared in memory, without running diff.
 def diff(file1, file2):
-  return os.system("diff -q '" + file1 + "' '" + file2 + "' > /dev/null") != 0
+  try:
+    if os.path.getsize(file1) != os.path.getsize(file2):
+      return True
+    with open(file1, "rb") as f1, open(file2, "rb") as f2:
+      return f1.read() != f2.read()
+  except OSError:
+    return True
+
+# Return the modification time of the given file, or None if it does not exist (with a single stat).
+def mtime(file_name):
+  try:
+    return os.stat(file_name).st_mtime
+  except FileNotFoundError:
+    return None
+
+# Write the given text to the given file atomically (via a temporary file that replaces it), so an interrupted write cannot
+# leave a partial file.
+def write_file_atomically(file_name, text):
+  tmp_file_name = file_name + ".tmp"
+  with open(tmp_file_name, "w") as file:
+    file.write(text)
+  os.replace(tmp_file_name, file_name)
 
 # Capture Verilog file in a new history/#/mod_#/, and if this was an LLM modification, capture messages.json and llm_response.txt.
 #  status: The status to save with the checkpoint, updated as new status.
@@ -710,18 +784,36 @@ def checkpoint(status, old_status = None):
   mod_num += 1
   mod_dir = mod_path()
   os.mkdir(mod_dir)
-  os.system("cp " + working_verilog_file_name + " " + mod_dir)
+  shutil.copyfile(working_verilog_file_name, mod_dir + "/" + working_verilog_file_name)
 
   # Capture messages.json if this was an LLM modification.
   if status.get("by") == "llm":
-    os.system("cp messages.json llm_response.txt " + mod_dir)
+    for file_name in ["messages.json", "llm_response.txt"]:
+      try:
+        shutil.copyfile(file_name, mod_dir + "/" + file_name)
+      except FileNotFoundError:
+        pass
   
   # Write status.json.
   writeStatus(status)
 
   # Make Verilog file read-only (to prevent inadvertent modification, esp. in meld).
   # ("status.json" may still be updated with FEV status.)
-  os.system("chmod a-w " + mod_dir + "/" + working_verilog_file_name)
+  make_read_only(mod_dir + "/" + working_verilog_file_name)
+
+# Remove write permission from the given file for all users (as "chmod a-w").
+def make_read_only(file_name):
+  mode = os.stat(file_name).st_mode
+  os.chmod(file_name, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+# Update the feved.v symlink to link to the given Verilog file.
+def update_feved(verilog_file_name):
+  # Create the new link alongside and rename it over feved.v, so feved.v is never missing.
+  tmp_link_name = "feved.v.tmp"
+  if os.path.islink(tmp_link_name):
+    os.remove(tmp_link_name)
+  os.symlink(verilog_file_name, tmp_link_name)
+  os.replace(tmp_link_name, "feved.v")
 
 
 # Create a reversion checkpoint as a symlink, or if the previous change was a reversion, update its symlink.
@@ -732,24 +824,37 @@ def checkpoint_reversion(prev_mod):
   else:
     mod_num += 1
   os.symlink("mod_" + str(prev_mod), mod_path())
+  actual_mod_cache.pop((refactoring_step, mod_num), None)
   # Update feved.v to link to the most-recent FEVed Verilog.
-  os.system("ln -sf " + most_recently_feved_verilog_file() + " feved.v")
+  update_feved(most_recently_feved_verilog_file())
+
+# Status of each modification, as read from or written to its status.json, keyed by (refactoring step, actual mod number).
+# This avoids re-reading status.json files as the history is walked. Entries are updated by writeStatus and must be
+# cleared if history is deleted.
+status_cache = {}
 
 def readStatus(mod = None):
   # Default mod to mod_num
   if mod is None:
     mod = mod_num
-  # Read status from latest history change directory.
-  try:
-    with open(mod_path(mod) + "/status.json") as file:
-      return json.load(file)
-  except:
-    return {}
+  key = (refactoring_step, actual_mod(mod))
+  if key not in status_cache:
+    # Read status from latest history change directory.
+    try:
+      with open(mod_path(mod) + "/status.json") as file:
+        status_cache[key] = json.load(file)
+    except:
+      return {}
+  # Return a copy, since callers update the status they read.
+  return dict(status_cache[key])
 
 def writeStatus(status):
   # Write status to latest history change directory.
+  # (Serialize first, so the file is written with a single write.)
+  status_str = json.dumps(status)
   with open(mod_path() + "/status.json", "w") as file:
-    json.dump(status, file)
+    file.write(status_str)
+  status_cache[(refactoring_step, actual_mod())] = dict(status)
 
 
 # Print the main user prompt.
@@ -796,16 +901,17 @@ def initialize_messages_json():
 
     # Initialize messages.json.
     with open("messages.json", "w") as message_file:
-      prompt = prompts[prompt_id]["prompt"]
+      prompt_obj = prompts[prompt_id]
+      prompt = prompt_obj["prompt"]
       # Add "needs" fields to the prompt.
-      if "needs" in prompts[prompt_id]:
+      if "needs" in prompt_obj:
         prompt += "\n\n" + "Note that the following attributes have been determined about the Verilog code:"
-        for field in prompts[prompt_id]["needs"]:
+        for field in prompt_obj["needs"]:
           prompt += "\n   " + field + ": " + status.get(field, "")
       message_obj = {}
       # If prompt has a "background" field, add it (first) to the message.
-      if "background" in prompts[prompt_id]:
-        message_obj["background"] = prompts[prompt_id]["background"]
+      if "background" in prompt_obj:
+        message_obj["background"] = prompt_obj["background"]
       message_obj["prompt"] = prompt
       messages = message_bundler.obj_to_request(message_obj)
       ejson_messages = to_extended_json(json.dumps(llm_api.initPrompt(system, messages), indent=4))
@@ -873,11 +979,10 @@ def init_refactoring_step():
   # Update state in files.
 
   # Write prompt_id.txt.
-  with open("prompt_id.txt", "w") as file:
-    file.write(str(prompt_id))
+  write_file_atomically("prompt_id.txt", str(prompt_id))
   # Make history/# directory and populate it.
   os.mkdir("history/" + str(refactoring_step))
-  os.system("cp prompt_id.txt history/" + str(refactoring_step) + "/")
+  write_file_atomically("history/" + str(refactoring_step) + "/prompt_id.txt", str(prompt_id))
   # Also, create an initial mod_0 directory populated with initial verilog and status.json indicating initial code.
   status = { "initial": True, "fev": "passed" }
   checkpoint(status, old_status)
@@ -912,12 +1017,16 @@ def run_fev(orig_file_name, working_verilog_file_name, use_eqy = True):
 
   # Create fev.sby or fev.eqy.
   fev_file = "fev.eqy" if use_eqy else "fev.sby"
-  # This is done by copying in <repo>/fev.sby and substituting "{MODULE_NAME}", "{ORIGINAL_FILE}", and "{MODIFIED_FILE}" using sed.
-  os.system(f"cp " + repo_dir + "/" + fev_file + " tmp")
-  os.system(f"sed -i 's/<MODULE_NAME>/{module_name}/g' tmp/" + fev_file)
+  # This is done by substituting "<MODULE_NAME>", "<ORIGINAL_FILE>", and "<MODIFIED_FILE>" in the <repo>/fev.sby or fev.eqy template.
+  # (The template is read for each run, so edits to it take effect without a restart.)
+  with open(repo_dir + "/" + fev_file) as file:
+    fev_script = file.read()
+  fev_script = fev_script.replace("<MODULE_NAME>", module_name)
   # These paths must be absolute.
-  os.system(f"sed -i 's|<ORIGINAL_FILE>|{os.getcwd()}/{orig_file_name}|g' tmp/" + fev_file)
-  os.system(f"sed -i 's|<MODIFIED_FILE>|{os.getcwd()}/{working_verilog_file_name}|g' tmp/" + fev_file)
+  fev_script = fev_script.replace("<ORIGINAL_FILE>", os.getcwd() + "/" + orig_file_name)
+  fev_script = fev_script.replace("<MODIFIED_FILE>", os.getcwd() + "/" + working_verilog_file_name)
+  with open("tmp/" + fev_file, "w") as file:
+    file.write(fev_script)
   # To run the above manually in bash, as a one-liner from the conversion directory, providing <MODULE_NAME>, <ORIGINAL_FILE>, and <MODIFIED_FILE>:
   #   cp ../fev.sby fev.sby && sed -i 's/<MODULE_NAME>/<module_name>/g' fev.sby && sed -i "s|<ORIGINAL_FILE>|$PWD/<original_file>|g" fev.sby && sed -i "s|<MODIFIED_FILE>|$PWD/<modified_file>|g" fev.sby
 
@@ -932,6 +1041,22 @@ def run_fev(orig_file_name, working_verilog_file_name, use_eqy = True):
   # TODO: If failed, bundle failure info for LLM, and call LLM (with approval).
   return proc.returncode == 0
 
+# Regular expressions for LLM comments that are updated before FEV (matching within a line).
+temporary_comment_line_re = re.compile(r"^[^\S\n]*//[^\S\n]*LLM:[^\S\n]*Temporary:.*\n?", re.MULTILINE)
+temporary_comment_re = re.compile(r"[^\S\n]*//[^\S\n]*LLM:[^\S\n]*Temporary:.*")
+new_task_comment_re = re.compile(r"^(.*?)//[^\S\n]*LLM:[^\S\n]*New Task:", re.MULTILINE)   # (First on each line.)
+# Regular expressions for whole lines containing comments that must be addressed before accepting a refactoring step.
+task_comment_line_re = re.compile(r"^.*LLM: (?:New|Old) Task:.*$", re.MULTILINE)
+user_comment_line_re = re.compile(r"^.*//[^\S\n]*User:.*$", re.MULTILINE)
+
+# Return the lines of the given file containing comments that must be addressed before accepting the changes (as grep would
+# report them), or "" if there are none.
+def leftover_comments(file_name):
+  with open(file_name) as file:
+    code = file.read()
+  lines = task_comment_line_re.findall(code) + user_comment_line_re.findall(code)
+  return "".join(line + "\n" for line in lines)
+
 # Run FEV against the last successfully FEVed code (if not in this refactoring step, the the original code for this step).
 # Update status.json.
 # use_eqy: Use EQY instead of SymbiYosys.
@@ -940,11 +1065,17 @@ def fev_current(use_eqy = True, use_original = False):
 
   # This is a good time to strip temporary comments from the LLM and change New Task comments to Old Task.
   # We've found it sometimes convenient to ask the LLM to insert these so it doesn't forget what it has done.
-  os.system("sed -i '/^\s*\/\/\s*LLM:\s*Temporary:.*/d' " + working_verilog_file_name)  # Whole line.
+  # (The file is read and written once.)
+  with open(working_verilog_file_name) as file:
+    code = file.read()
+  new_code = temporary_comment_line_re.sub("", code)  # Whole line.
   # Also remove these at the end of a line without deleting the line.
-  os.system("sed -i '/^\s*\/\/\s*LLM:\s*Temporary:.*//' " + working_verilog_file_name)
+  new_code = temporary_comment_re.sub("", new_code)
   # Change "New Task" to "Old Task".
-  os.system("sed -i 's/\/\/\s*LLM:\s*New Task:/\/\/ LLM: Old Task:/' " + working_verilog_file_name)
+  new_code = new_task_comment_re.sub(r"\1// LLM: Old Task:", new_code)
+  if new_code != code:
+    with open(working_verilog_file_name, "w") as file:
+      file.write(new_code)
   
   checkpoint_if_pending()
 
@@ -954,7 +1085,10 @@ def fev_current(use_eqy = True, use_original = False):
   
   print("Running FEV against " + orig_file_name + ". Diff:")
   print("==================")
-  diff_status = os.system("diff " + orig_file_name + " " + working_verilog_file_name)
+  # (Run diff to show changes only if there are any.)
+  diff_status = 0
+  if diff(orig_file_name, working_verilog_file_name):
+    diff_status = subprocess.run(["diff", orig_file_name, working_verilog_file_name]).returncode
   print("==================")
   
   ret = False
@@ -972,7 +1106,7 @@ def fev_current(use_eqy = True, use_original = False):
       print("FEV passed.")
       status["fev"] = "passed"
       # Update feved.v to link to newly-FEVed code.
-      os.system("ln -sf " + mod_path() + "/" + working_verilog_file_name + " feved.v")
+      update_feved(mod_path() + "/" + working_verilog_file_name)
     else:
       print("Error: FEV failed. Try again.")
       status["fev"] = "failed"
@@ -992,6 +1126,23 @@ def mod_path(mod = None):
     mod = mod_num
   return "history/" + str(refactoring_step) + "/mod_" + str(mod)
 
+# Actual modification numbers, keyed by (refactoring step, mod number), to avoid checking for symlinks as the history is
+# walked. Entries must be removed when reversion symlinks are created or updated and cleared if history is deleted.
+actual_mod_cache = {}
+
+# Get the actual modification of the given modification number (or current). In other words, if the given mod is a
+# reversion, follow the symlink.
+def actual_mod(mod=None):
+  if mod is None:
+    mod = mod_num
+  key = (refactoring_step, mod)
+  if key not in actual_mod_cache:
+    if os.path.islink(mod_path(mod)):
+      actual_mod_cache[key] = int(os.readlink(mod_path(mod))[4:])
+    else:
+      actual_mod_cache[key] = mod
+  return actual_mod_cache[key]
+
 # Show a diff between the given (or current) modification and the previous one.
 # Return true is shown, or false if there is no previous modification.
 def show_diff(mod = None, prev_mod = None):
@@ -1008,7 +1159,8 @@ def show_diff(mod = None, prev_mod = None):
   # Show the diff.
   print("Diff between mod_" + str(prev_mod) + " and mod_" + str(mod) + ":")
   print("==================")
-  os.system("diff " + mod_path(prev_mod) + "/" + working_verilog_file_name + " " + mod_path(mod) + "/" + working_verilog_file_name)
+  if diff(mod_path(prev_mod) + "/" + working_verilog_file_name, mod_path(mod) + "/" + working_verilog_file_name):
+    subprocess.run(["diff", mod_path(prev_mod) + "/" + working_verilog_file_name, mod_path(mod) + "/" + working_verilog_file_name])
   print("==================")
   return True
 
@@ -1018,15 +1170,22 @@ def show_diff(mod = None, prev_mod = None):
 # Terminal input #
 ##################
 
-def set_raw_mode(fd):
+# Return the (raw, cooked) terminal attributes, both derived from a single read of the current attributes.
+# (These are read fresh, so changes made to the terminal, e.g. by subprocesses, are preserved.)
+def terminal_modes(fd):
     attrs = termios.tcgetattr(fd)  # get current attributes
-    attrs[3] = attrs[3] & ~termios.ICANON  # clear ICANON flag
-    termios.tcsetattr(fd, termios.TCSANOW, attrs)  # set new attributes
+    raw_attrs = list(attrs)
+    raw_attrs[3] = attrs[3] & ~termios.ICANON  # clear ICANON flag
+    cooked_attrs = list(attrs)
+    cooked_attrs[3] = attrs[3] | termios.ICANON  # set ICANON flag
+    return raw_attrs, cooked_attrs
 
-def set_cooked_mode(fd):
-    attrs = termios.tcgetattr(fd)  # get current attributes
-    attrs[3] = attrs[3] | termios.ICANON # set ICANON flag
-    termios.tcsetattr(fd, termios.TCSANOW, attrs)  # set new attributes
+# modes: (opt) The result of terminal_modes(fd), if already read.
+def set_raw_mode(fd, modes=None):
+    termios.tcsetattr(fd, termios.TCSANOW, (modes or terminal_modes(fd))[0])  # set new attributes
+
+def set_cooked_mode(fd, modes=None):
+    termios.tcsetattr(fd, termios.TCSANOW, (modes or terminal_modes(fd))[1])  # set new attributes
 
 # Set to default cooked mode (in case the last run was exited in raw mode).
 set_cooked_mode(sys.stdin.fileno())
@@ -1034,16 +1193,16 @@ set_cooked_mode(sys.stdin.fileno())
 def getch():
   ## Save the current terminal settings
   #old_settings = termios.tcgetattr(sys.stdin)
+  # Read the terminal attributes once for both mode changes.
+  modes = terminal_modes(sys.stdin.fileno())
   try:
     # Set the terminal to raw mode
-    set_raw_mode(sys.stdin.fileno())
-    # Wait for input to be available
-    [i], _, _ = select([sys.stdin.fileno()], [], [], None)
-    # Read a single character
+    set_raw_mode(sys.stdin.fileno(), modes)
+    # Read a single character (blocking until one is available)
     ch = sys.stdin.read(1)
   finally:
     # Restore the terminal settings
-    set_cooked_mode(sys.stdin.fileno())
+    set_cooked_mode(sys.stdin.fileno(), modes)
   return ch
 
 def prompt(prompt, options=None, default=None):
@@ -1111,8 +1270,14 @@ def press_any_key(note=""):
 def set_mod_num():
   global mod_num
   mod_num = -1
-  while os.path.exists(mod_path(mod_num + 1)):
-    mod_num += 1
+  # Scan the refactoring step's directory once for the highest mod_#, rather than testing for each mod in turn.
+  try:
+    with os.scandir("history/" + str(refactoring_step)) as it:
+      for entry in it:
+        if entry.name.startswith("mod_") and entry.name[4:].isdigit():
+          mod_num = max(mod_num, int(entry.name[4:]))
+  except FileNotFoundError:
+    pass
 
 
 
@@ -1176,47 +1341,40 @@ prompt_id = 0  # The current prompt ID (prompt_id.txt).
 if not os.path.exists("history"):
   # Initialize the conversion job.
   os.mkdir("history")
-  if not os.path.exists("tmp"):
-    os.mkdir("tmp")
-  if not os.path.exists("feved.v"):
-    os.system("ln -s ../history/1/mod_0/" + working_verilog_file_name + " feved.v")
+  os.makedirs("tmp", exist_ok=True)
+  try:
+    os.symlink("../history/1/mod_0/" + working_verilog_file_name, "feved.v")
+  except FileExistsError:
+    pass
   init_refactoring_step()
 else:
   # Determine the current state of the conversion process.
-  # Find the current refactoring step.
-  for step in os.listdir("history"):
-    refactoring_step = max(refactoring_step, int(step))
+  # Find the current refactoring step (the history directories, most recent first).
+  steps = sorted((int(step) for step in os.listdir("history")), reverse=True)
+  if steps:
+    refactoring_step = steps[0]
   # Find the current modification number.
   set_mod_num()
 
   # Get the prompt ID from the most recent prompt_id.txt file. Look back through the history directories until/if one is found.
-  cn = refactoring_step
-  while cn >= 0 and prompt_id == 0:
-    if os.path.exists("history/" + str(cn) + "/prompt_id.txt"):
-      with open("history/" + str(cn) + "/prompt_id.txt") as f:
+  for step in steps:
+    try:
+      with open("history/" + str(step) + "/prompt_id.txt") as f:
         prompt_id = int(f.read())
-    cn -= 1
+    except FileNotFoundError:
+      continue
+    if prompt_id != 0:
+      break
   
   # If messages.json is older than prompts.json or default_system_message.txt, reinitialize it.
-  if (not os.path.exists("messages.json")) or (os.path.getmtime("messages.json") < os.path.getmtime(repo_dir + "/prompts.json")) or (os.path.getmtime("messages.json") < os.path.getmtime(repo_dir + "/default_system_message.txt")):
+  messages_mtime = mtime("messages.json")
+  if (messages_mtime is None) or (messages_mtime < os.path.getmtime(repo_dir + "/prompts.json")) or (messages_mtime < os.path.getmtime(repo_dir + "/default_system_message.txt")):
     # Confirm.
     ch = prompt("messages.json is missing or out of date. Reinitialize?", {"y", "n"}, "y")
     if ch == "y":
       initialize_messages_json()
 
 
-# Get the actual modification of the given modification number (or current). In other words, if the given mod is a
-# reversion, follow the symlink.
-def actual_mod(mod=None):
-  if mod is None:
-    mod = mod_num
-  if os.path.islink(mod_path(mod)):
-    tmp1 = os.readlink(mod_path(mod))[4:]
-    tmp2 = int(tmp1)
-    return tmp2
-  else:
-    return mod
-
 # Reset the current prompt (which was just started) to a new one.
 # type: "u" for unaccepted, "r" for reinitialize.
 # prev_prompt_id: The prompt ID of the previous step (to be incremented if "r").
@@ -1228,6 +1386,8 @@ def reset_prompt(type, prev_prompt_id):
 
   # Delete the history directory.
   shutil.rmtree("history/" + str(refactoring_step))
+  status_cache.clear()
+  actual_mod_cache.clear()
   # Decrement the refactoring step number.
   refactoring_step -= 1
   set_mod_num()
@@ -1254,8 +1414,10 @@ def reset_prompt(type, prev_prompt_id):
 while True:
 
   # Determine whether the default_system_message.txt file has been modified after messages.json.
-  if os.path.exists(repo_dir + "/default_system_message.txt") and os.path.exists("messages.json"):
-    if os.path.getmtime(repo_dir + "/default_system_message.txt") > os.path.getmtime("messages.json"):
+  system_message_mtime = mtime(repo_dir + "/default_system_message.txt")
+  messages_mtime = mtime("messages.json")
+  if system_message_mtime is not None and messages_mtime is not None:
+    if system_message_mtime > messages_mtime:
       print("Warning: default_system_message.txt has been modified since messages.json.")
       print("         Use \"u\" (repeated as needed), then \"r\" to reset the current refactoring step to pick up changes.\n")
   # Prompt the user.
@@ -1301,27 +1463,27 @@ while True:
       confirm = True
       do_it = False
       last_mod = most_recent_mod()
-      # Scan the file for comments that should have been removed.
-      # Capture grep output to report problematic lines.
-      grep_output = os.popen("grep -E 'LLM: (New|Old) Task:' " + working_verilog_file_name).read()
-      grep_output += os.popen("grep -E '//\s*User:' " + working_verilog_file_name).read()
       if diff(working_verilog_file_name, mod_path() + "/" + working_verilog_file_name):
         print("Code edits are pending. You must run FEV (or revert) before accepting the refactoring changes.")
       elif status.get("fev") != "passed":
         print("FEV was not run on the current file or did not pass. Choose a different command.")
-      elif grep_output != "":
-        print("The following comments were found in the code that must be addressed before accepting the changes:")
-        print(grep_output)
-      elif status.get("incomplete", True):
-        if status.get("incomplete", False):
-          print("LLM reported that the refactoring is incomplete.")
-        else:
-          print("LLM has not been run.")
-        do_it = True
       else:
-        # All good.
-        do_it = True
-        confirm = False
+        # Scan the file for comments that should have been removed (only once the checks above pass).
+        # Capture the offending lines to report them.
+        grep_output = leftover_comments(working_verilog_file_name)
+        if grep_output != "":
+          print("The following comments were found in the code that must be addressed before accepting the changes:")
+          print(grep_output)
+        elif status.get("incomplete", True):
+          if status.get("incomplete", False):
+            print("LLM reported that the refactoring is incomplete.")
+          else:
+            print("LLM has not been run.")
+          do_it = True
+        else:
+          # All good.
+          do_it = True
+          confirm = False
       
       if do_it and confirm:
         ch = prompt("Are you sure you want to accept this refactoring step as complete?", {"y", "n"}, "n")
@@ -1348,9 +1510,8 @@ while True:
         print("       Use \"u\" to revert to the beginning of the current prompt.")
         continue
       # List all prompts.
-      print("Prompts:")
-      for i in range(len(prompts)):
-        print(f"  {i}: {prompts[i]['desc']}")
+      # (Rendered as a single block and written with one print.)
+      print("Prompts:\n" + "\n".join(f"  {i}: {prompt_obj['desc']}" for i, prompt_obj in enumerate(prompts)))
       print("\nNote: It may necessary to manually update \"status.json\" to reflect values provided/consumed by LLM/prompts, then exit/restart.\n")
       # Get the prompt number.
       print("Enter the prompt number to apply.")
@@ -1422,11 +1583,13 @@ while True:
         print("Reverting to the previous version of the code.")
         show_diff(mod, prev_mod)
         # Copy the checkpointed verilog, messages.json (if it exists), and llm_response.txt (if it exists).
-        os.system("cp " + mod_path(prev_mod) + "/" + working_verilog_file_name + " " + working_verilog_file_name)
-        if os.path.exists(mod_path(prev_mod) + "/messages.json"):
-          os.system("cp " + mod_path(prev_mod) + "/messages.json messages.json")
-        if os.path.exists(mod_path(prev_mod) + "/llm_response.txt"):
-          os.system("cp " + mod_path(prev_mod) + "/llm_response.txt llm_response.txt")
+        prev_mod_dir = mod_path(prev_mod)
+        shutil.copyfile(prev_mod_dir + "/" + working_verilog_file_name, working_verilog_file_name)
+        for file_name in ["messages.json", "llm_response.txt"]:
+          try:
+            shutil.copyfile(prev_mod_dir + "/" + file_name, file_name)
+          except FileNotFoundError:
+            pass
 
         # Create a reversion checkpoint as a symlink, either as a new checkpoint or by updating the existing symlink.
         checkpoint_reversion(prev_mod)
@@ -1440,12 +1603,16 @@ while True:
       mod = actual_mod()
       # Find all symlinks to this change for which the next sequential modification is a non-link directory. Each is a candidate for redoing.
       candidates = []
-      for mod_dir in os.listdir("history/" + str(refactoring_step)):
-        if os.path.islink("history/" + str(refactoring_step) + "/" + mod_dir) and os.readlink("history/" + str(refactoring_step) + "/" + mod_dir) == "mod_" + str(mod):
+      # Scan the step directory once. (Directory entries cache their type, avoiding a stat per mod.)
+      with os.scandir("history/" + str(refactoring_step)) as it:
+        entries = {entry.name: entry for entry in it}
+      for mod_dir, entry in entries.items():
+        if entry.is_symlink() and os.readlink(entry.path) == "mod_" + str(mod):
           # This is a symlink to the current mod.
           # Check if the next mod is a symlink.
           m = int(mod_dir.split("_")[1])
-          if not os.path.islink("history/" + str(refactoring_step) + "/mod_" + str(m + 1)) and os.path.isdir("history/" + str(refactoring_step) + "/mod_" + str(m + 1)):
+          next_entry = entries.get("mod_" + str(m + 1))
+          if next_entry is not None and not next_entry.is_symlink() and next_entry.is_dir():
             candidates.append(m)
       
       # List all candidates.